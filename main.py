@@ -1,28 +1,60 @@
-import os, json, re, unicodedata
-from datetime import datetime
+import os, re, unicodedata, hashlib, hmac, secrets, asyncio, base64, logging
+from datetime import datetime, timedelta
 from typing import List
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import RedirectResponse
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import Fernet
+import jwt
+from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi.responses import RedirectResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import aioredis, asyncpg, uvicorn
+import aioredis, asyncpg, orjson, uvicorn
+from aioredis.exceptions import ResponseError
 from authlib.integrations.starlette_client import OAuth, OAuthError
 from starlette.config import Config
 from starlette.requests import Request as StarletteRequest
 from starlette.middleware.sessions import SessionMiddleware
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
 
 # =====================
 # CONFIG
 # =====================
 DATABASE_URL = os.getenv("DATABASE_URL")
 REDIS_URL = os.getenv("REDIS_URL")
-PORT = 8000
+PG_SOCKET_DIR = os.getenv("PG_SOCKET_DIR", "/var/run/postgresql")
+REDIS_SOCKET = os.getenv("REDIS_SOCKET", "/var/run/redis/redis-server.sock")
+PORT = int(os.getenv("PORT", "8000"))
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1")
 
 OWNER_SECRET = os.getenv("OWNER_SECRET", "only-owner-can-train")
+API_KEY_SECRET = os.getenv("API_KEY_SECRET", "change-me-api-key-secret")
+ADMIN_JWT_SECRET = os.getenv("ADMIN_JWT_SECRET", "change-me-admin-jwt-secret")
+ADMIN_TOKEN_TTL = 3600
 
 MEMORY_TTL = 3 * 24 * 60 * 60
 MEMORY_MAX_ENTRIES = 10
 MAX_PROMPT_LEN = 4000
+DEFAULT_RATE = os.getenv("DEFAULT_RATE", "60/minute")
+
+API_KEY_MAX_USES = 1000
+API_KEY_TTL_DAYS = 30
+API_KEY_CACHE_TTL = 60
+USES_FLUSH_INTERVAL = 1.0
+
+AUDIT_KEY = os.getenv("AUDIT_KEY") or base64.urlsafe_b64encode(
+    hashlib.sha256(API_KEY_SECRET.encode()).digest()
+)
+AUDIT_FLUSH_MAX = 500
+AUDIT_FLUSH_INTERVAL = 0.1
+AUDIT_RETRY_DELAY = 1.0
+AUDIT_Q_MAX = 10000
+AUDIT_PARTITION_INTERVAL = 24 * 60 * 60
+
+SCHEMA_LOCK_ID = 0x4E4F424C
 
 BLOCK_PATTERNS = [
     r"(ignore|bypass).*(rules|policy)",
@@ -30,10 +62,24 @@ BLOCK_PATTERNS = [
     r"(admin|root|password|drop|delete)",
 ]
 
+BLOCK_RE = re.compile(
+    "|".join(f"(?:{p})" for p in BLOCK_PATTERNS),
+    re.IGNORECASE
+)
+
+log = logging.getLogger("nobltyai")
+
 # =====================
 # APP INIT
 # =====================
-app = FastAPI(title="NOBLTY AI", version="1.0")
+app = FastAPI(title="NOBLTY AI", version="1.0", default_response_class=ORJSONResponse)
+
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=REDIS_URL if REDIS_URL else "memory://"
+)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 app.add_middleware(
     CORSMiddleware,
@@ -50,13 +96,100 @@ app.add_middleware(
 # =====================
 # REDIS + DATABASE
 # =====================
+def redis_connect_url():
+    if urlparse(REDIS_URL).hostname in LOCAL_HOSTS and os.path.exists(REDIS_SOCKET):
+        return f"unix://{REDIS_SOCKET}"
+    return REDIS_URL
+
+def pg_connect_kwargs():
+    u = urlparse(DATABASE_URL)
+    if u.hostname in LOCAL_HOSTS and os.path.isdir(PG_SOCKET_DIR):
+        return {
+            "host": PG_SOCKET_DIR,
+            "port": u.port or 5432,
+            "user": u.username,
+            "password": u.password,
+            "database": (u.path or "/postgres").lstrip("/")
+        }
+    return {"dsn": DATABASE_URL}
+
 @app.on_event("startup")
 async def startup():
-    app.state.redis = await aioredis.from_url(REDIS_URL)
-    app.state.db = await asyncpg.create_pool(DATABASE_URL)
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2)
+    )
+    app.state.redis = await aioredis.from_url(redis_connect_url())
+
+    pg_kwargs = pg_connect_kwargs()
+    c = await asyncpg.connect(**pg_kwargs)
+    try:
+        await c.execute("SELECT pg_advisory_lock($1)", SCHEMA_LOCK_ID)
+        await c.execute("""
+            CREATE TABLE IF NOT EXISTS api_keys (
+                id BIGSERIAL PRIMARY KEY,
+                email TEXT NOT NULL,
+                key_hash TEXT NOT NULL,
+                key_lookup TEXT NOT NULL,
+                uses INT NOT NULL DEFAULT 0,
+                max_uses INT NOT NULL DEFAULT 1000,
+                expires_at TIMESTAMP NOT NULL,
+                revoked BOOLEAN NOT NULL DEFAULT FALSE,
+                created TIMESTAMP NOT NULL DEFAULT now()
+            )
+        """)
+        await c.execute("DROP INDEX IF EXISTS api_keys_lookup_idx")
+        await c.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS api_keys_lookup_inc_idx "
+            "ON api_keys (key_lookup) "
+            "INCLUDE (id, email, key_hash, uses, max_uses, expires_at, revoked)"
+        )
+        await c.execute("""
+            CREATE TABLE IF NOT EXISTS audit_logs (
+                id BIGSERIAL,
+                api_key_id BIGINT,
+                email TEXT NOT NULL,
+                endpoint TEXT NOT NULL,
+                meta BYTEA,
+                ts TIMESTAMP NOT NULL DEFAULT now()
+            ) PARTITION BY RANGE (ts)
+        """)
+        await ensure_audit_partitions(c)
+        await c.execute("SELECT pg_advisory_unlock($1)", SCHEMA_LOCK_ID)
+    finally:
+        await c.close()
+
+    app.state.db = await asyncpg.create_pool(
+        connection_class=PoolConnection,
+        init=prepare_statements,
+        **pg_kwargs
+    )
+
+    app.state.uses_flusher = asyncio.create_task(flush_key_uses())
+    app.state.audit_flusher = asyncio.create_task(flush_audit_logs())
+    app.state.partition_checker = asyncio.create_task(ensure_partitions_loop())
 
 @app.on_event("shutdown")
 async def shutdown():
+    app.state.uses_flusher.cancel()
+    app.state.audit_flusher.cancel()
+    app.state.partition_checker.cancel()
+    try:
+        await app.state.uses_flusher
+    except (asyncio.CancelledError, Exception):
+        pass
+    try:
+        await app.state.audit_flusher
+    except (asyncio.CancelledError, Exception):
+        pass
+    try:
+        await flush_key_uses_once()
+        batch = []
+        while not AUDIT_Q.empty():
+            batch.append(AUDIT_Q.get_nowait())
+        if batch:
+            await write_audit_batch(batch)
+    except Exception:
+        pass
     await app.state.redis.close()
     await app.state.db.close()
 
@@ -102,6 +235,12 @@ class TrainModel(BaseModel):
     instruction: str
     examples: List[dict]
 
+class CreateKeyModel(BaseModel):
+    email: str
+
+class RevokeKeyModel(BaseModel):
+    id: int
+
 # =====================
 # HELPERS
 # =====================
@@ -113,26 +252,229 @@ def detect_language(text: str) -> str:
 def validate_prompt(prompt: str):
     if len(prompt) > MAX_PROMPT_LEN:
         raise HTTPException(400, "Prompt too long")
-    for p in BLOCK_PATTERNS:
-        if re.search(p, prompt.lower()):
-            raise HTTPException(400, "Prompt blocked by safety rules")
+    if BLOCK_RE.search(prompt):
+        raise HTTPException(400, "Prompt blocked by safety rules")
+
+# =====================
+# DATABASE DEPENDENCY
+# =====================
+async def db(request: Request):
+    async with request.app.state.db.acquire() as c:
+        yield c
+
+# =====================
+# API KEYS
+# =====================
+def key_digest(key: str) -> str:
+    return hmac.new(API_KEY_SECRET.encode(), key.encode(), hashlib.sha256).hexdigest()
+
+KEY_LOOKUP_SQL = (
+    "SELECT id, email, key_hash, uses, max_uses, expires_at "
+    "FROM api_keys WHERE key_lookup=$1 AND revoked=false"
+)
+
+class PoolConnection(asyncpg.Connection):
+    __slots__ = ("stmt_key_lookup",)
+
+async def prepare_statements(c):
+    c.stmt_key_lookup = await c.prepare(KEY_LOOKUP_SQL)
+
+_JWT = jwt.PyJWT()
+_JWT_SECRET = ADMIN_JWT_SECRET.encode()
+
+def admin_create_token() -> str:
+    payload = {
+        "role": "owner",
+        "exp": datetime.utcnow() + timedelta(seconds=ADMIN_TOKEN_TTL)
+    }
+    return _JWT.encode(payload, _JWT_SECRET, algorithm="HS256")
+
+def admin_verify_token(token: str) -> bool:
+    try:
+        claims = _JWT.decode(token, _JWT_SECRET, algorithms=["HS256"])
+    except jwt.PyJWTError:
+        return False
+    return claims.get("role") == "owner"
+
+def require_owner(request: Request):
+    auth = request.headers.get("authorization", "")
+    if auth.startswith("Bearer ") and admin_verify_token(auth[7:]):
+        return
+    secret = request.headers.get("x-owner-secret", "")
+    if not secrets.compare_digest(secret, OWNER_SECRET):
+        raise HTTPException(403, "Owner secret required")
+
+fernet = Fernet(AUDIT_KEY)
+AUDIT_Q = asyncio.Queue(maxsize=AUDIT_Q_MAX)
+
+def month_start(dt):
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+async def ensure_audit_partitions(c):
+    await c.execute("SELECT pg_advisory_lock($1)", SCHEMA_LOCK_ID)
+    try:
+        start = month_start(datetime.utcnow())
+        for _ in range(2):
+            end = month_start(start + timedelta(days=32))
+            await c.execute(
+                f"CREATE TABLE IF NOT EXISTS audit_logs_{start:%Y_%m} "
+                f"PARTITION OF audit_logs "
+                f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+            )
+            start = end
+    finally:
+        await c.execute("SELECT pg_advisory_unlock($1)", SCHEMA_LOCK_ID)
+
+async def ensure_partitions_loop():
+    while True:
+        await asyncio.sleep(AUDIT_PARTITION_INTERVAL)
+        try:
+            async with app.state.db.acquire() as c:
+                await ensure_audit_partitions(c)
+        except Exception:
+            log.exception("audit partition check failed")
+
+def record_audit(api_key_id, email, endpoint, meta):
+    try:
+        AUDIT_Q.put_nowait((api_key_id, email, endpoint, meta, datetime.utcnow()))
+    except asyncio.QueueFull:
+        log.warning("audit queue full, dropping audit row for key %s", api_key_id)
+
+def encrypt_audit_batch(batch):
+    return [
+        (kid, email, endpoint, fernet.encrypt(orjson.dumps(meta)), ts)
+        for kid, email, endpoint, meta, ts in batch
+    ]
+
+async def write_audit_batch(batch):
+    records = await asyncio.to_thread(encrypt_audit_batch, batch)
+    async with app.state.db.acquire() as c:
+        await c.copy_records_to_table(
+            "audit_logs",
+            records=records,
+            columns=["api_key_id", "email", "endpoint", "meta", "ts"]
+        )
+
+async def flush_audit_logs():
+    pending = []
+    try:
+        while True:
+            if not pending:
+                pending.append(await AUDIT_Q.get())
+            await asyncio.sleep(AUDIT_FLUSH_INTERVAL)
+            while len(pending) < AUDIT_FLUSH_MAX and not AUDIT_Q.empty():
+                pending.append(AUDIT_Q.get_nowait())
+            try:
+                await write_audit_batch(pending)
+                pending = []
+            except Exception:
+                log.exception("audit flush failed; retrying batch of %d", len(pending))
+                try:
+                    async with app.state.db.acquire() as c:
+                        await ensure_audit_partitions(c)
+                except Exception:
+                    log.exception("audit partition check failed")
+                await asyncio.sleep(AUDIT_RETRY_DELAY)
+    finally:
+        for item in pending:
+            try:
+                AUDIT_Q.put_nowait(item)
+            except asyncio.QueueFull:
+                break
+
+async def verify_api_key(key: str, meta: dict):
+    lookup = key_digest(key)
+    cache_key = f"ak:{lookup}"
+    cached = await app.state.redis.get(cache_key)
+
+    if cached:
+        entry = orjson.loads(cached)
+    else:
+        async with app.state.db.acquire() as c:
+            row = await c.stmt_key_lookup.fetchrow(lookup)
+        if not row or not hmac.compare_digest(lookup, row["key_hash"]):
+            raise HTTPException(403, "Invalid API key")
+        entry = {
+            "id": row["id"],
+            "email": row["email"],
+            "uses": row["uses"],
+            "max_uses": row["max_uses"],
+            "expires_at": row["expires_at"].isoformat()
+        }
+        await app.state.redis.set(cache_key, orjson.dumps(entry), ex=API_KEY_CACHE_TTL)
+
+    if datetime.fromisoformat(entry["expires_at"]) < datetime.utcnow():
+        await app.state.redis.delete(cache_key)
+        raise HTTPException(403, "API key expired")
+
+    delta = await app.state.redis.hincrby("ak:uses", str(entry["id"]), 1)
+    if entry["uses"] + delta > entry["max_uses"]:
+        await app.state.redis.hincrby("ak:uses", str(entry["id"]), -1)
+        raise HTTPException(403, "API key usage limit reached")
+
+    record_audit(entry["id"], entry["email"], "/ask", meta)
+    return entry
+
+async def flush_key_uses_once():
+    async with app.state.redis.pipeline(transaction=True) as p:
+        p.hgetall("ak:uses")
+        p.delete("ak:uses")
+        deltas, _ = await p.execute()
+
+    if not deltas:
+        return
+
+    ids = [int(k) for k in deltas]
+    counts = [int(v) for v in deltas.values()]
+    try:
+        async with app.state.db.acquire() as c:
+            await c.execute(
+                "UPDATE api_keys AS a SET uses = a.uses + v.delta "
+                "FROM (SELECT unnest($1::bigint[]) AS id, unnest($2::int[]) AS delta) v "
+                "WHERE a.id = v.id",
+                ids, counts
+            )
+    except BaseException:
+        async with app.state.redis.pipeline(transaction=True) as p:
+            for k, v in deltas.items():
+                p.hincrby("ak:uses", k, int(v))
+            await p.execute()
+        raise
+
+async def flush_key_uses():
+    while True:
+        await asyncio.sleep(USES_FLUSH_INTERVAL)
+        try:
+            await flush_key_uses_once()
+        except Exception:
+            log.exception("uses flush failed; deltas restored for retry")
 
 # =====================
 # MEMORY
 # =====================
 async def get_memory(email: str):
-    data = await app.state.redis.get(f"mem:{email}")
-    return json.loads(data) if data else []
+    key = f"mem:{email}"
+    try:
+        items = await app.state.redis.lrange(key, 0, -1)
+    except ResponseError:
+        # legacy JSON-string key from before the list format
+        await app.state.redis.delete(key)
+        return []
+    return [orjson.loads(i) for i in items]
 
 async def save_memory(email: str, prompt: str, answer: str):
-    mem = await get_memory(email)
-    mem.append({"q": prompt, "a": answer})
-    mem = mem[-MEMORY_MAX_ENTRIES:]
-    await app.state.redis.set(
-        f"mem:{email}",
-        json.dumps(mem),
-        ex=MEMORY_TTL
-    )
+    key = f"mem:{email}"
+    entry = orjson.dumps({"q": prompt, "a": answer})
+    for _ in range(2):
+        try:
+            async with app.state.redis.pipeline(transaction=True) as p:
+                p.rpush(key, entry)
+                p.ltrim(key, -MEMORY_MAX_ENTRIES, -1)
+                p.expire(key, MEMORY_TTL)
+                await p.execute()
+            return
+        except ResponseError:
+            await app.state.redis.delete(key)
 
 # =====================
 # LANGUAGE CORE
@@ -140,13 +482,13 @@ async def save_memory(email: str, prompt: str, answer: str):
 class LanguageCore:
     def analyze(self, prompt: str, lang: str, memory: list) -> dict:
         intent = "general"
-        p = prompt.lower()
+        prefix = prompt[:8].lower()
 
-        if p.endswith("?"):
+        if prompt.endswith("?"):
             intent = "question"
-        elif p.startswith(("how", "why", "explain")):
+        elif prefix.startswith(("how", "why", "explain")):
             intent = "explanation"
-        elif p.startswith(("create", "make", "build")):
+        elif prefix.startswith(("create", "make", "build")):
             intent = "instruction"
 
         context = " ".join(m["a"] for m in memory[-3:])
@@ -192,11 +534,60 @@ def merge_answers(a: str, b: str, lang: str):
 async def health():
     return {"status": "ok"}
 
+@app.post("/admin/token")
+async def admin_token(request: Request):
+    secret = request.headers.get("x-owner-secret", "")
+    if not secrets.compare_digest(secret, OWNER_SECRET):
+        raise HTTPException(403, "Owner secret required")
+    return {"token": admin_create_token(), "expires_in": ADMIN_TOKEN_TTL}
+
+@app.post("/admin/keys")
+async def create_key(data: CreateKeyModel, request: Request, c=Depends(db)):
+    require_owner(request)
+
+    key_plain = secrets.token_urlsafe(28)
+    digest = key_digest(key_plain)
+    expires_at = datetime.utcnow() + timedelta(days=API_KEY_TTL_DAYS)
+
+    row = await c.fetchrow(
+        "INSERT INTO api_keys (email, key_hash, key_lookup, max_uses, expires_at) "
+        "VALUES ($1, $2, $3, $4, $5) RETURNING id",
+        data.email, digest, digest,
+        API_KEY_MAX_USES, expires_at
+    )
+
+    return {
+        "id": row["id"],
+        "api_key": key_plain,
+        "expires_at": expires_at.isoformat()
+    }
+
+@app.post("/admin/keys/revoke")
+async def revoke_key(data: RevokeKeyModel, request: Request, c=Depends(db)):
+    require_owner(request)
+
+    lookup = await c.fetchval(
+        "UPDATE api_keys SET revoked=true WHERE id=$1 RETURNING key_lookup",
+        data.id
+    )
+
+    if not lookup:
+        raise HTTPException(404, "Key not found")
+
+    await app.state.redis.delete(f"ak:{lookup}")
+    return {"revoked": data.id}
+
 @app.post("/ask")
+@limiter.limit(DEFAULT_RATE)
 async def ask_ai(data: AskModel, request: Request):
-    email = request.session.get("user_email")
-    if not email:
-        raise HTTPException(403, "Login required")
+    api_key = request.headers.get("x-api-key")
+    if api_key:
+        key_row = await verify_api_key(api_key, {"prompt_len": len(data.prompt)})
+        email = key_row["email"]
+    else:
+        email = request.session.get("user_email")
+        if not email:
+            raise HTTPException(403, "Login required")
 
     validate_prompt(data.prompt)
 
@@ -205,8 +596,10 @@ async def ask_ai(data: AskModel, request: Request):
 
     core = language_core.analyze(data.prompt, lang, memory)
 
-    n_ans = NOBLTY.process(core)
-    a_ans = aastrax.process(core)
+    n_ans, a_ans = await asyncio.gather(
+        asyncio.to_thread(NOBLTY.process, core),
+        asyncio.to_thread(aastrax.process, core)
+    )
 
     final_answer = merge_answers(n_ans, a_ans, lang)
 
@@ -222,4 +615,11 @@ async def ask_ai(data: AskModel, request: Request):
 # RUN
 # =====================
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=PORT)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=PORT,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count()
+    )